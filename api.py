@@ -1,10 +1,12 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import uvicorn
 import json
 from main import generate_study_roadmap_async
+from roadmap_assembly import RunLimitExceeded, StreamedRoadmap
 
 # Load environment variables at startup
 load_dotenv()
@@ -24,6 +26,14 @@ class TopicRequest(BaseModel):
     topic: str
 
 
+async def stream_roadmap_response(topic, roadmap):
+    """Send a roadmap stored on disk in the usual response shape without loading it into memory"""
+    yield json.dumps({"status": "success", "topic": topic})[:-1].encode("utf-8") + b', "roadmap": '
+    async for chunk in roadmap.iter_chunks():
+        yield chunk
+    yield b"}"
+
+
 @app.post("/generate-roadmap-test/")
 async def create_roadmap(request: TopicRequest):
     try:
@@ -40,7 +50,11 @@ async def create_roadmap(request: TopicRequest):
     try:
         # Call the async function to generate the roadmap
         roadmap = await generate_study_roadmap_async(request.topic)
+        if isinstance(roadmap, StreamedRoadmap):
+            return StreamingResponse(stream_roadmap_response(request.topic, roadmap), media_type="application/json")
         return {"status": "success", "topic": request.topic, "roadmap": roadmap}
+    except RunLimitExceeded as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating roadmap: {str(e)}")
 
@@ -4,6 +4,8 @@ import time
 import asyncio
 import aiofiles
 from openai import AsyncOpenAI
+from shared_state import SharedState, estimate_tokens
+from roadmap_assembly import AssemblyConfig, NodeSpool
 
 # Assessment content schema definition
 ASSESSMENT_SCHEMA = {
@@ -64,12 +66,17 @@ ASSESSMENT_SCHEMA = {
 }
 
 class AssessmentGenerator:
-    def __init__(self, api_key):
+    def __init__(self, api_key, shared_state=None, assembly_config=None):
         """Initialize the AssessmentGenerator with an OpenAI API key"""
         self.client = AsyncOpenAI(api_key=api_key)
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
-        self.semaphore = asyncio.Semaphore(10)  # Limit to 10 concurrent requests
+        self.semaphore = asyncio.Semaphore(10)  # Limit to 10 concurrent requests per worker
+        self.shared_state = shared_state or SharedState()  # Rate budget shared by all workers
+        self.assembly_config = assembly_config or AssemblyConfig()
+        # Separate from self.semaphore (held inside generate_assessments) so lessons are only
+        # loaded into memory once their subtopic is allowed to run
+        self.subtopic_slots = asyncio.Semaphore(10)
     
     async def generate_assessments(self, topic, main_topic, subtopic, lesson_content):
         """Generate flashcards and quiz questions for a specific subtopic based on its lesson content"""
@@ -109,9 +116,12 @@ IMPORTANT:
         # Maximum retries for API calls
         max_retries = 3
         
+        estimated_tokens = estimate_tokens(system_prompt, prompt)
+        
         async with self.semaphore:  # Limit concurrent requests
             for attempt in range(max_retries):
                 try:
+                    reservation_id = await self.shared_state.acquire_budget(estimated_tokens)
                     response = await self.client.chat.completions.create(
                         model="gpt-3.5-turbo-0125",
                         messages=[
@@ -121,6 +131,7 @@ IMPORTANT:
                         tools=[{"type": "function", "function": ASSESSMENT_SCHEMA}],
                         tool_choice={"type": "function", "function": {"name": "generate_assessments"}}
                     )
+                    await self.shared_state.record_usage(reservation_id, response)
                     
                     # Extract the function arguments from the response
                     function_args = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
@@ -130,8 +141,7 @@ IMPORTANT:
                     os.makedirs(subtopic_dir, exist_ok=True)
                     
                     output_file = f"{subtopic_dir}/{subtopic['id']}_assessments.json"
-                    async with aiofiles.open(output_file, "w") as f:
-                        await f.write(json.dumps(function_args, indent=2))
+                    await self.shared_state.write_json(output_file, function_args)
                     
                     print(f"✅ Generated {len(function_args['flashcards'])} flashcards and {len(function_args['quiz'])} quiz questions for: {subtopic_title}")
                     return function_args
@@ -170,6 +180,12 @@ IMPORTANT:
         roadmap = {"roadmap": []}
         tasks = []
         
+        # In streaming mode finished subtopic nodes go to a spool file and children only hold ids
+        spool = None
+        if self.assembly_config.streaming:
+            spool = NodeSpool(f"{self.output_dir}/{topic.lower()}/roadmap_nodes.spool")
+            await spool.open()
+        
         # Process each main topic and its subtopics
         for main_topic in topic_structure["topics"]:
             main_topic_id = main_topic["id"]
@@ -189,25 +205,38 @@ IMPORTANT:
             # Process each subtopic
             for subtopic in main_topic["subtopics"]:
                 # Add task to process subtopic
-                task = self.process_subtopic(topic, main_topic, subtopic, main_topic_node, lesson_content)
+                task = asyncio.ensure_future(self.process_subtopic(topic, main_topic, subtopic, main_topic_node, lesson_content, spool))
                 tasks.append(task)
+                if spool:
+                    main_topic_node["children"].append(subtopic["id"])
             
             # Add main topic to roadmap
             roadmap["roadmap"].append(main_topic_node)
         
         # Wait for all tasks to complete
-        await asyncio.gather(*tasks)
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # Let cancelled tasks finish (and any spool writes settle) before dropping the spool
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if spool:
+                await spool.discard()
+            raise
         
         # Save the complete roadmap
         output_file = f"{self.output_dir}/{topic.lower()}_roadmap.json"
-        async with aiofiles.open(output_file, "w") as f:
-            await f.write(json.dumps(roadmap, indent=2))
+        if spool:
+            roadmap = await spool.assemble(output_file, roadmap["roadmap"])
+        else:
+            await self.shared_state.write_json(output_file, roadmap)
         
         print(f"\n✅ Complete roadmap with all content and assessments saved to: {output_file}")
         return roadmap
     
-    async def process_subtopic(self, topic, main_topic, subtopic, main_topic_node, lesson_content):
-        """Process a single subtopic and update the main_topic_node"""
+    async def process_subtopic(self, topic, main_topic, subtopic, main_topic_node, lesson_content, spool=None):
+        """Process a single subtopic and update the main_topic_node (or append it to the spool)"""
         subtopic_id = subtopic["id"]
         subtopic_title = subtopic["title"]
         
@@ -217,6 +246,24 @@ IMPORTANT:
             print(f"Warning: No lesson content found for {subtopic_title}, skipping assessments...")
             return
         
+        async with self.subtopic_slots:
+            # Streaming mode only passed a reference to the lesson file; inline lessons were
+            # already counted by the content step and the node shares the same string
+            held_bytes = 0
+            if "content" not in subtopic_content:
+                async with aiofiles.open(subtopic_content["lesson_file"], "r") as f:
+                    subtopic_content = json.loads(await f.read())
+                held_bytes = self.assembly_config.reserve(subtopic_content["content"])
+            try:
+                await self.build_subtopic_node(topic, main_topic, subtopic, main_topic_node, subtopic_content, spool)
+            finally:
+                self.assembly_config.release(held_bytes)
+    
+    async def build_subtopic_node(self, topic, main_topic, subtopic, main_topic_node, subtopic_content, spool):
+        """Generate assessments for a subtopic and add its node to the roadmap"""
+        subtopic_id = subtopic["id"]
+        subtopic_title = subtopic["title"]
+        
         # Generate assessments based on the lesson content
         assessments = await self.generate_assessments(topic, main_topic, subtopic, subtopic_content)
         
@@ -244,7 +291,10 @@ IMPORTANT:
         }
         
         # Add subtopic node to main topic
-        main_topic_node["children"].append(subtopic_node)
+        if spool:
+            await spool.append(main_topic["id"], subtopic_node)
+        else:
+            main_topic_node["children"].append(subtopic_node)
 
 # For compatibility with synchronous code
 def sync_wrapper(async_func):
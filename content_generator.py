@@ -2,16 +2,19 @@ import json
 import os
 import time
 import asyncio
-import aiofiles
 from openai import AsyncOpenAI
+from shared_state import SharedState, estimate_tokens
+from roadmap_assembly import AssemblyConfig, RunLimitExceeded
 
 class ContentGenerator:
-    def __init__(self, api_key):
+    def __init__(self, api_key, shared_state=None, assembly_config=None):
         """Initialize the ContentGenerator with an OpenAI API key"""
         self.client = AsyncOpenAI(api_key=api_key)
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
-        self.semaphore = asyncio.Semaphore(10)  # Limit to 10 concurrent requests
+        self.semaphore = asyncio.Semaphore(10)  # Limit to 10 concurrent requests per worker
+        self.shared_state = shared_state or SharedState()  # Rate budget shared by all workers
+        self.assembly_config = assembly_config or AssemblyConfig()
     
     async def generate_lesson_content(self, topic, main_topic, subtopic):
         """Generate detailed lesson content for a specific subtopic using raw prompting"""
@@ -57,9 +60,12 @@ Format your response to start with the detailed content of the lesson. Keep the
         # Maximum retries for API calls
         max_retries = 3
         
+        estimated_tokens = estimate_tokens(system_prompt, prompt)
+        
         async with self.semaphore:  # Limit concurrent requests
             for attempt in range(max_retries):
                 try:
+                    reservation_id = await self.shared_state.acquire_budget(estimated_tokens)
                     response = await self.client.chat.completions.create(
                         # model="gpt-4.1-nano",
                         model="gpt-3.5-turbo",
@@ -68,6 +74,7 @@ Format your response to start with the detailed content of the lesson. Keep the
                             {"role": "user", "content": prompt}
                         ]
                     )
+                    await self.shared_state.record_usage(reservation_id, response)
                     
                     # Extract the content from the response
                     content_text = response.choices[0].message.content
@@ -78,6 +85,9 @@ Format your response to start with the detailed content of the lesson. Keep the
                     else:
                         content = content_text.strip()
                     
+                    # Count the lesson while this run holds it; process_subtopic decides when to release it
+                    held_bytes = self.assembly_config.reserve(content)
+                    
                     # Create result structure
                     lesson_content = {
                         "description": subtopic_description,
@@ -89,12 +99,17 @@ Format your response to start with the detailed content of the lesson. Keep the
                     os.makedirs(subtopic_dir, exist_ok=True)
                     
                     output_file = f"{subtopic_dir}/{subtopic['id']}_lesson.json"
-                    async with aiofiles.open(output_file, "w") as f:
-                        await f.write(json.dumps(lesson_content, indent=2))
+                    try:
+                        await self.shared_state.write_json(output_file, lesson_content)
+                    except BaseException:
+                        self.assembly_config.release(held_bytes)
+                        raise
                     
                     print(f"✅ Generated lesson content for: {subtopic_title}")
-                    return lesson_content
+                    return {**lesson_content, "lesson_file": output_file, "held_bytes": held_bytes}
                     
+                except RunLimitExceeded:
+                    raise
                 except Exception as e:
                     if attempt < max_retries - 1:
                         print(f"Error generating content for {subtopic_title}: {str(e)}. Retrying ({attempt+1}/{max_retries})...")
@@ -102,9 +117,11 @@ Format your response to start with the detailed content of the lesson. Keep the
                     else:
                         print(f"Failed after {max_retries} attempts for {subtopic_title}: {str(e)}")
                         # Return minimal content as fallback
+                        content = f"Content generation failed for {subtopic_title}. Please try regenerating this content."
                         return {
                             "description": subtopic_description,
-                            "content": f"Content generation failed for {subtopic_title}. Please try regenerating this content."
+                            "content": content,
+                            "held_bytes": self.assembly_config.reserve(content)
                         }
     
     async def generate_all_lesson_content(self, topic, topic_structure):
@@ -127,16 +144,21 @@ Format your response to start with the detailed content of the lesson. Keep the
             # Process each subtopic
             for subtopic in main_topic["subtopics"]:
                 # Create a task for each subtopic
-                task = self.process_subtopic(topic, main_topic, subtopic, all_content)
+                task = asyncio.ensure_future(self.process_subtopic(topic, main_topic, subtopic, all_content))
                 tasks.append(task)
         
         # Wait for all tasks to complete
-        await asyncio.gather(*tasks)
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
         
         # Save the complete content structure
         output_file = f"{self.output_dir}/{topic.lower()}_content.json"
-        async with aiofiles.open(output_file, "w") as f:
-            await f.write(json.dumps(all_content, indent=2))
+        await self.shared_state.write_json(output_file, all_content)
         
         print(f"\n✅ All lesson content generated and saved to: {output_file}")
         return all_content
@@ -149,7 +171,17 @@ Format your response to start with the detailed content of the lesson. Keep the
         # Generate lesson content
         lesson_content = await self.generate_lesson_content(topic, main_topic, subtopic)
         
-        # Store in our structure
+        # In streaming mode only keep a reference; the lesson is re-read from disk for assessments
+        if self.assembly_config.streaming and "lesson_file" in lesson_content:
+            all_content[main_topic_id]["subtopics"][subtopic_id] = {
+                "title": subtopic["title"],
+                "description": lesson_content["description"],
+                "lesson_file": lesson_content["lesson_file"]
+            }
+            self.assembly_config.release(lesson_content["held_bytes"])
+            return
+        
+        # Store in our structure; the lesson stays in memory (and reserved) for the rest of the run
         all_content[main_topic_id]["subtopics"][subtopic_id] = {
             "title": subtopic["title"],
             "description": lesson_content["description"],
@@ -1,29 +1,61 @@
 import argparse
+import asyncio
+import json
 import os
+import time
 from dotenv import load_dotenv
 from topic_generator import TopicGenerator
 from content_generator import ContentGenerator
 from assessment_generator import AssessmentGenerator
+from shared_state import SharedState
+from roadmap_assembly import AssemblyConfig, StreamedRoadmap
 
-def generate_study_roadmap(topic):
+def load_roadmap_finished_since(topic, started_at, assembly_config):
+    """Return the saved roadmap if another worker finished it after `started_at`, else None"""
+    roadmap_file = f"output/{topic.lower()}_roadmap.json"
+    try:
+        if os.path.getmtime(roadmap_file) < started_at:
+            return None
+        if assembly_config.streaming:
+            return StreamedRoadmap(roadmap_file)
+        with open(roadmap_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def generate_study_roadmap(topic, assembly_config=None):
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI_API_KEY not found in environment variables. Please check your .env file.")
     
+    shared_state = SharedState()
+    assembly_config = assembly_config or AssemblyConfig()
+    started_at = time.time()
+    
+    # Only one process generates a given topic at a time
+    with shared_state.topic_lock_sync(topic):
+        roadmap = load_roadmap_finished_since(topic, started_at, assembly_config)
+        if roadmap is not None:
+            print(f"\n♻️ Roadmap for {topic} was just generated by another worker, reusing it.")
+            return roadmap
+        return _generate_study_roadmap(topic, api_key, shared_state, assembly_config)
+
+def _generate_study_roadmap(topic, api_key, shared_state, assembly_config):
     # Step 1: Generate topic structure
     print("\n🔍 STEP 1: Generating topic structure...")
-    topic_generator = TopicGenerator(api_key)
+    topic_generator = TopicGenerator(api_key, shared_state)
     topic_structure = topic_generator.generate_topic_structure(topic)
+    assembly_config.check_structure(topic_structure)
     
     # Step 2: Generate lesson content for each subtopic (using async method)
     print("\n📝 STEP 2: Generating lesson content...")
-    content_generator = ContentGenerator(api_key)
+    content_generator = ContentGenerator(api_key, shared_state, assembly_config)
     # Use the sync wrapper function that internally runs the async function
     lesson_content = content_generator.generate_all_lesson_content_sync(topic, topic_structure)
     
     # Step 3: Generate flashcards and quiz questions and build roadmap (using async method)
     print("\n📚 STEP 3: Generating flashcards and quizzes...")
-    assessment_generator = AssessmentGenerator(api_key)
+    assessment_generator = AssessmentGenerator(api_key, shared_state, assembly_config)
     # Use the sync wrapper function that internally runs the async function
     roadmap = assessment_generator.enhance_all_content_sync(topic, topic_structure, lesson_content)
     
@@ -32,25 +64,40 @@ def generate_study_roadmap(topic):
     
     return roadmap
 
-async def generate_study_roadmap_async(topic):
+async def generate_study_roadmap_async(topic, assembly_config=None):
     api_key = os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI_API_KEY not found in environment variables. Please check your .env file.")
     
+    shared_state = SharedState()
+    assembly_config = assembly_config or AssemblyConfig()
+    started_at = time.time()
+    
+    # Only one worker generates a given topic at a time; the others wait and reuse its result
+    async with shared_state.topic_lock(topic):
+        roadmap = load_roadmap_finished_since(topic, started_at, assembly_config)
+        if roadmap is not None:
+            print(f"\n♻️ Roadmap for {topic} was just generated by another worker, reusing it.")
+            return roadmap
+        return await _generate_study_roadmap_async(topic, api_key, shared_state, assembly_config)
+
+async def _generate_study_roadmap_async(topic, api_key, shared_state, assembly_config):
     # Step 1: Generate topic structure
     print("\n🔍 STEP 1: Generating topic structure...")
-    topic_generator = TopicGenerator(api_key)
-    topic_structure = topic_generator.generate_topic_structure(topic)
+    topic_generator = TopicGenerator(api_key, shared_state)
+    # The topic generator is synchronous (and may wait on the shared budget), so keep it off the event loop
+    topic_structure = await asyncio.to_thread(topic_generator.generate_topic_structure, topic)
+    assembly_config.check_structure(topic_structure)
     
     # Step 2: Generate lesson content for each subtopic (using async method directly)
     print("\n📝 STEP 2: Generating lesson content...")
-    content_generator = ContentGenerator(api_key)
+    content_generator = ContentGenerator(api_key, shared_state, assembly_config)
     # Use the async function directly
     lesson_content = await content_generator.generate_all_lesson_content(topic, topic_structure)
     
     # Step 3: Generate flashcards and quiz questions and build roadmap (using async method directly)
     print("\n📚 STEP 3: Generating flashcards and quizzes...")
-    assessment_generator = AssessmentGenerator(api_key)
+    assessment_generator = AssessmentGenerator(api_key, shared_state, assembly_config)
     # Use the async function directly
     roadmap = await assessment_generator.enhance_all_content(topic, topic_structure, lesson_content)
     
@@ -64,13 +111,15 @@ def main():
     
     parser = argparse.ArgumentParser(description="Generate a study roadmap for any subject")
     parser.add_argument("--topic", type=str, help="Subject to generate a topic structure for")
+    parser.add_argument("--streaming", action="store_true", help="Write roadmap nodes to disk as they finish instead of holding them in memory")
     args = parser.parse_args()
     
     topic = args.topic
     if not topic:
         topic = input("Enter a subject to generate a topic structure for: ")
     
-    generate_study_roadmap(topic)
+    assembly_config = AssemblyConfig(streaming=True) if args.streaming else None
+    generate_study_roadmap(topic, assembly_config)
 
 if __name__ == "__main__":
     main()
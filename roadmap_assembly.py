@@ -0,0 +1,137 @@
+import json
+import os
+import asyncio
+
+import aiofiles
+from shared_state import atomic_open
+
+
+class RunLimitExceeded(Exception):
+    """Raised when a run would go over the configured subtopic or memory cap"""
+
+
+class AssemblyConfig:
+    def __init__(self, streaming=None, max_subtopics=None, max_memory_mb=None):
+        """Per-run assembly settings, read from the environment unless given explicitly.
+
+        In streaming mode lesson text is not kept in memory between steps: lessons are
+        re-read from their files and finished roadmap nodes are spooled to disk, so only
+        ids and offsets stay in memory until the final roadmap file is stitched together."""
+        if streaming is None:
+            streaming = os.environ.get("CRAMLY_STREAMING_ASSEMBLY", "").lower() in ("1", "true", "yes")
+        if max_subtopics is None:
+            max_subtopics = int(os.environ.get("CRAMLY_MAX_SUBTOPICS", "150"))
+        if max_memory_mb is None:
+            max_memory_mb = int(os.environ.get("CRAMLY_MAX_RUN_MEMORY_MB", "64"))
+        self.streaming = streaming
+        self.max_subtopics = max_subtopics
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.held_bytes = 0
+
+    def check_structure(self, topic_structure):
+        """Reject topic structures with more subtopics than the cap before any content is generated"""
+        subtopic_count = sum(len(main_topic["subtopics"]) for main_topic in topic_structure["topics"])
+        if subtopic_count > self.max_subtopics:
+            raise RunLimitExceeded(
+                f"Topic structure has {subtopic_count} subtopics, the limit is {self.max_subtopics} (CRAMLY_MAX_SUBTOPICS)"
+            )
+        return subtopic_count
+
+    def reserve(self, text):
+        """Account for lesson text held in memory by this run, failing if it goes over the cap.
+
+        Only lesson text is counted; assessments and rendered nodes are small next to it."""
+        size = len(text.encode("utf-8"))
+        if self.held_bytes + size > self.max_memory_bytes:
+            raise RunLimitExceeded(
+                f"Run would hold {self.held_bytes + size} bytes of content, "
+                f"the limit is {self.max_memory_bytes} (CRAMLY_MAX_RUN_MEMORY_MB)"
+            )
+        self.held_bytes += size
+        return size
+
+    def release(self, size):
+        """Give back bytes accounted for with reserve()"""
+        self.held_bytes -= size
+
+
+class NodeSpool:
+    def __init__(self, spool_file):
+        """Append-only file of rendered subtopic nodes, indexed by subtopic id"""
+        self.spool_file = spool_file
+        os.makedirs(os.path.dirname(spool_file) or ".", exist_ok=True)
+        self.offsets = {}  # (main topic id, subtopic id) -> (offset, length)
+        self.size = 0
+        self.lock = asyncio.Lock()
+        self.file = None
+
+    async def open(self):
+        self.file = await aiofiles.open(self.spool_file, "wb")
+
+    async def append(self, main_topic_id, node):
+        """Render a subtopic node and append it to the spool, keeping only its offset in memory"""
+        data = json.dumps(node, indent=2).encode("utf-8")
+        async with self.lock:
+            await self.file.write(data)
+            self.offsets[(main_topic_id, node["id"])] = (self.size, len(data))
+            self.size += len(data)
+
+    async def assemble(self, output_file, main_topic_nodes, chunk_size=64 * 1024):
+        """Stream the final roadmap JSON to `output_file`, copying spooled nodes in structure order.
+
+        `main_topic_nodes` are main topic nodes whose "children" hold subtopic ids. The file
+        is written through atomic_open so readers never see a partial roadmap."""
+        await self.file.close()
+        try:
+            await asyncio.to_thread(self._assemble_sync, output_file, main_topic_nodes, chunk_size)
+        finally:
+            if os.path.exists(self.spool_file):
+                os.remove(self.spool_file)
+        return StreamedRoadmap(output_file)
+
+    def _assemble_sync(self, output_file, main_topic_nodes, chunk_size):
+        with open(self.spool_file, "rb") as spool, atomic_open(output_file, "wb") as out:
+            out.write(b'{"roadmap": [')
+            for i, main_topic_node in enumerate(main_topic_nodes):
+                header = {key: value for key, value in main_topic_node.items() if key != "children"}
+                # Reuse json.dumps for the header fields and reopen the object for the children
+                if i:
+                    out.write(b", ")
+                out.write(json.dumps(header)[:-1].encode("utf-8") + b', "children": [')
+                written = 0
+                for subtopic_id in main_topic_node["children"]:
+                    key = (main_topic_node["id"], subtopic_id)
+                    if key not in self.offsets:
+                        continue  # Skipped subtopic (no lesson content)
+                    offset, length = self.offsets[key]
+                    if written:
+                        out.write(b", ")
+                    spool.seek(offset)
+                    while length > 0:
+                        chunk = spool.read(min(chunk_size, length))
+                        out.write(chunk)
+                        length -= len(chunk)
+                    written += 1
+                out.write(b"]}")
+            out.write(b"]}")
+
+    async def discard(self):
+        """Close and delete the spool when a run fails before assembly"""
+        if self.file is not None:
+            await self.file.close()
+        if os.path.exists(self.spool_file):
+            os.remove(self.spool_file)
+
+
+class StreamedRoadmap:
+    def __init__(self, path):
+        """A roadmap that lives on disk and is read back in chunks instead of loaded whole"""
+        self.path = path
+
+    async def iter_chunks(self, chunk_size=64 * 1024):
+        async with aiofiles.open(self.path, "rb") as f:
+            while True:
+                chunk = await f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
@@ -0,0 +1,194 @@
+import json
+import os
+import time
+import asyncio
+import sqlite3
+import fcntl
+import hashlib
+import tempfile
+from contextlib import closing, contextmanager, asynccontextmanager
+
+# Read the process umask once at import (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextmanager
+def atomic_open(path, mode="w"):
+    """Open a temp file next to `path` and rename it over `path` once the block succeeds.
+
+    Readers only ever see the old or the complete new file. The temp file gets the
+    permissions a plain open() would have used, since mkstemp creates it owner-only."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        os.fchmod(fd, 0o666 & ~_UMASK)
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SharedState:
+    def __init__(self, state_dir=None, requests_per_minute=None, tokens_per_minute=None):
+        """Initialize shared state used by every worker process on this machine.
+
+        Locks live as files under the state directory and the rate budget is kept
+        in a SQLite database next to them, so all uvicorn/gunicorn workers started
+        from the same checkout coordinate through the same files."""
+        self.state_dir = state_dir or os.environ.get("CRAMLY_STATE_DIR", "output/.state")
+        self.lock_dir = f"{self.state_dir}/locks"
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.db_path = f"{self.state_dir}/budget.sqlite3"
+        if requests_per_minute is None:
+            requests_per_minute = int(os.environ.get("CRAMLY_REQUESTS_PER_MINUTE", "500"))
+        if tokens_per_minute is None:
+            tokens_per_minute = int(os.environ.get("CRAMLY_TOKENS_PER_MINUTE", "200000"))
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.poll_interval = 0.1
+        self.schema_ready = False
+
+    def _connect(self):
+        """Open a connection that waits on other workers instead of failing with 'database is locked'.
+
+        This can block for a while, so async callers go through asyncio.to_thread."""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self.schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS budget_log ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, reserved_at REAL NOT NULL, tokens INTEGER NOT NULL)"
+            )
+            self.schema_ready = True
+        return closing(conn)
+
+    # ---- Topic-level generation locks ----
+
+    def _lock_path(self, topic):
+        # Output files are keyed by topic.lower(); the hash keeps e.g. "C++" and "C##" apart
+        safe_topic = "".join(c if c.isalnum() or c in "-_" else "_" for c in topic.lower())
+        topic_hash = hashlib.sha1(topic.lower().encode("utf-8")).hexdigest()[:10]
+        return f"{self.lock_dir}/{safe_topic}-{topic_hash}.lock"
+
+    @contextmanager
+    def topic_lock_sync(self, topic):
+        """Hold an exclusive cross-process lock for a topic (blocking)"""
+        with open(self._lock_path(topic), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @asynccontextmanager
+    async def topic_lock(self, topic):
+        """Hold an exclusive cross-process lock for a topic without blocking the event loop.
+
+        The lock is released by the OS if the worker dies, so a crashed run never
+        leaves a topic stuck."""
+        with open(self._lock_path(topic), "w") as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(self.poll_interval)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # ---- Global request/token budget ----
+
+    def try_acquire_budget(self, tokens):
+        """Reserve one request and an estimated number of tokens in the last 60 seconds.
+
+        The budget is a sliding window over a log of reservations, so a full budget at the
+        end of one minute can't be followed by another full budget right after it.
+        Returns (0, reservation_id) on success, otherwise (seconds to wait, None)."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM budget_log WHERE reserved_at <= ?", (now - 60,))
+            rows = conn.execute("SELECT reserved_at, tokens FROM budget_log ORDER BY reserved_at").fetchall()
+            used_tokens = sum(row_tokens for _, row_tokens in rows)
+
+            # Drop the oldest reservations until this request fits; the last one dropped
+            # tells us when enough of the window has expired. A single request larger than
+            # the whole token budget is let through on an empty window.
+            wait_until = None
+            requests, remaining_tokens = len(rows), used_tokens
+            for reserved_at, row_tokens in rows:
+                fits_tokens = remaining_tokens + tokens <= self.tokens_per_minute or remaining_tokens == 0
+                if requests + 1 <= self.requests_per_minute and fits_tokens:
+                    break
+                wait_until = reserved_at + 60
+                requests -= 1
+                remaining_tokens -= row_tokens
+
+            if wait_until is not None:
+                conn.execute("COMMIT")
+                return max(wait_until - now, self.poll_interval), None
+
+            cursor = conn.execute("INSERT INTO budget_log (reserved_at, tokens) VALUES (?, ?)", (now, tokens))
+            conn.execute("COMMIT")
+            return 0, cursor.lastrowid
+
+    def acquire_budget_sync(self, tokens):
+        """Block until the shared budget has room for one request of roughly `tokens` tokens.
+
+        Returns the reservation id to pass to record_usage_sync."""
+        while True:
+            wait, reservation_id = self.try_acquire_budget(tokens)
+            if not wait:
+                return reservation_id
+            time.sleep(wait)
+
+    async def acquire_budget(self, tokens):
+        """Wait until the shared budget has room for one request of roughly `tokens` tokens.
+
+        Returns the reservation id to pass to record_usage."""
+        while True:
+            wait, reservation_id = await asyncio.to_thread(self.try_acquire_budget, tokens)
+            if not wait:
+                return reservation_id
+            await asyncio.sleep(wait)
+
+    def record_usage_sync(self, reservation_id, response):
+        """Replace a reservation's estimate with the real token count reported by the API"""
+        usage = getattr(response, "usage", None)
+        actual_tokens = getattr(usage, "total_tokens", None)
+        if actual_tokens is None:
+            return
+        with self._connect() as conn:
+            conn.execute("UPDATE budget_log SET tokens = ? WHERE id = ?", (actual_tokens, reservation_id))
+
+    async def record_usage(self, reservation_id, response):
+        """Async version of record_usage_sync that keeps SQLite off the event loop"""
+        await asyncio.to_thread(self.record_usage_sync, reservation_id, response)
+
+    # ---- Atomic artifact writes ----
+
+    def write_json_sync(self, path, data):
+        """Write JSON to a temp file in the same directory and rename it over `path`"""
+        with atomic_open(path) as f:
+            json.dump(data, f, indent=2)
+
+    async def write_json(self, path, data):
+        """Async version of write_json_sync; readers only ever see a complete file.
+
+        json.dump encodes straight into the file, so the rendered JSON is never held
+        in memory as one string."""
+        await asyncio.to_thread(self.write_json_sync, path, data)
+
+
+def estimate_tokens(*texts, completion_tokens=1000):
+    """Rough token estimate (~4 characters per token) plus room for the completion"""
+    return sum(len(text) for text in texts) // 4 + completion_tokens
@@ -2,6 +2,7 @@ import json
 import os
 import time
 from openai import OpenAI
+from shared_state import SharedState, estimate_tokens
 
 # Topic structure schema definition
 TOPIC_STRUCTURE_SCHEMA = {
@@ -56,11 +57,12 @@ TOPIC_STRUCTURE_SCHEMA = {
 }
 
 class TopicGenerator:
-    def __init__(self, api_key):
+    def __init__(self, api_key, shared_state=None):
         """Initialize the TopicGenerator with an OpenAI API key"""
         self.client = OpenAI(api_key=api_key)
         self.output_dir = "output"
         os.makedirs(self.output_dir, exist_ok=True)
+        self.shared_state = shared_state or SharedState()  # Rate budget shared by all workers
     
     def generate_topic_structure(self, topic):
         """Generate main topics and subtopics for a given subject using function calling"""
@@ -99,8 +101,10 @@ Assign proper IDs to main topics (main-1, main-2, etc.) and subtopics (main-1-1,
         
         # Maximum retries for API calls
         max_retries = 3
+        estimated_tokens = estimate_tokens(system_prompt, prompt, completion_tokens=3000)
         for attempt in range(max_retries):
             try:
+                reservation_id = self.shared_state.acquire_budget_sync(estimated_tokens)
                 response = self.client.chat.completions.create(
                     model="gpt-3.5-turbo-0125",
                     messages=[
@@ -110,14 +114,14 @@ Assign proper IDs to main topics (main-1, main-2, etc.) and subtopics (main-1-1,
                     tools=[{"type": "function", "function": TOPIC_STRUCTURE_SCHEMA}],
                     tool_choice={"type": "function", "function": {"name": "generate_topic_structure"}}
                 )
+                self.shared_state.record_usage_sync(reservation_id, response)
                 
                 # Extract the function arguments from the response
                 function_args = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
                 
                 # Save result
                 output_file = f"{self.output_dir}/{topic.lower()}_structure.json"
-                with open(output_file, "w") as f:
-                    json.dump(function_args, f, indent=2)
+                self.shared_state.write_json_sync(output_file, function_args)
                     
                 print(f"✅ Generated {len(function_args['topics'])} main topics with subtopics")
                 print(f"✅ Saved to: {output_file}")